@@ -4,75 +4,524 @@ import os
 import subprocess
 import time
 import datetime
-import glob
-from pathlib import Path
 import argparse
 import sys
 import shutil
+import io
+import struct
+import asyncio
+import collections
+import contextlib
+import logging
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 
-# Function to get current timestamp
-def timestamp():
-    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# pypdfium2 (with Pillow) is optional: when installed, PDFs are rasterized in
+# process instead of forking Ghostscript or ImageMagick for every PDF
+try:
+    import pypdfium2 as pdfium
+    import PIL  # noqa: F401 - required by PdfBitmap.to_pil()
+except ImportError:
+    pdfium = None
 
-# Function to log and print messages
-def log_print(message, log_file, quiet=False):
-    with open(log_file, "a") as f:
-        f.write(f"{message}\n")
-    if not quiet or "Error:" in message:
-        print(message)
+# tesserocr is optional: when installed, each worker keeps one Tesseract engine
+# loaded for all of its pages instead of starting the tesseract command per page
+HAVE_TESSEROCR = importlib.util.find_spec("tesserocr") is not None
+
+# Buffer size for the log file; records are written out in blocks, not one by one
+LOG_BUFFER_SIZE = 1 << 16
+
+# Every PNG, and so every page in gs's or convert's output stream, starts with this
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+logger = logging.getLogger("preprocess_pdfs")
+
+# Per-worker state set up by init_worker(): the Tesseract engine, the log
+# record collector and the command paths resolved once by the main process
+_tess_api = None
+_log_collector = None
+_inherited_handlers = []
+_gs_bin = None
+_convert_bin = None
+_tesseract_bin = None
+
+# FileHandler that leaves flushing to its write buffer instead of every record
+class BufferedFileHandler(logging.FileHandler):
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=LOG_BUFFER_SIZE, encoding=self.encoding, errors=self.errors)
+
+    def flush(self):
+        pass  # close() still writes out whatever is left in the buffer
+
+# Handler that keeps a worker's log records so the main process can write them out
+class RecordCollector(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    # Function to hand over the records collected so far
+    def take(self):
+        records, self.records = self.records, []
+        return records
+
+# Function to send log records to the log file and, unless quiet, the terminal
+def setup_logging(log_file, quiet):
+    formatter = logging.Formatter("%(asctime)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    file_handler = BufferedFileHandler(log_file)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.ERROR if quiet else logging.INFO)
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# Settings each worker needs to process a PDF
+@dataclass(frozen=True)
+class Config:
+    output_dir: str
+    keep_pdfs: bool
+    keep_pngs: bool
+    no_delete: bool
+    error_handling: str
+    single_file: str = None
+    ocr_concurrency: int = 1
+    dpi: int = 200
+    force_ocr: bool = False
+    render_threads: int = 1
+
+# Outcome of processing some or all pages of one PDF, handed back from a worker
+# to the main process, which adds up the results for each PDF
+@dataclass
+class PdfResult:
+    pdf_file: str
+    success_pages: int = 0
+    fail_pages: int = 0
+    errors: int = 0
+    file_had_error: bool = False
+    render_failed: bool = False
+    write_failed: bool = False  # the PDF's text did not make it into --single-file
+    exit_requested: bool = False
+    log_records: list[logging.LogRecord] = field(default_factory=list)
+    texts: list[tuple[str, str]] = field(default_factory=list)  # (header, text) for --single-file
 
 # Function to delete PDF file
-def delete_pdf(pdf_file, log_file, quiet, no_delete, keep_pdfs):
+def delete_pdf(pdf_file, no_delete, keep_pdfs):
     if no_delete or keep_pdfs:
-        log_print(f"{timestamp()}: Skipping deletion of {pdf_file} per user option.", log_file, quiet)
+        logger.info(f"Skipping deletion of {pdf_file} per user option.")
         return 0
-    log_print(f"{timestamp()}: Deleting {pdf_file}...", log_file, quiet)
+    logger.info(f"Deleting {pdf_file}...")
     try:
         os.remove(pdf_file)
     except Exception as e:
-        log_print(f"{timestamp()}: Error: Failed to delete {pdf_file}: {e}", log_file, quiet)
+        logger.error(f"Error: Failed to delete {pdf_file}: {e}")
         return 1
     return 0
 
-# Function to delete PNG file
-def delete_png(png_file, log_file, quiet, no_delete, keep_pngs):
-    if no_delete or keep_pngs:
-        log_print(f"{timestamp()}: Skipping deletion of {png_file} per user option.", log_file, quiet)
-        return 0
-    log_print(f"{timestamp()}: Deleting {png_file}...", log_file, quiet)
+# Function to handle errors based on user preference
+def handle_error(error_msg, error_handling):
+    logger.error(error_msg)
+    if error_handling == "exit":
+        logger.info("Exiting script due to error as per --error-handling 'exit' option.")
+        sys.exit(1)
+
+# Function to set up a worker process before it receives any pages
+def init_worker(gs_bin, convert_bin, tesseract_bin):
+    global _tess_api, _log_collector, _inherited_handlers, _gs_bin, _convert_bin, _tesseract_bin
+    _gs_bin = gs_bin
+    _convert_bin = convert_bin
+    _tesseract_bin = tesseract_bin
+    # Keep this worker's log records for the main process rather than writing
+    # them through any handlers inherited from it. The inherited handlers stay
+    # referenced: a forked copy of the log file's buffer would otherwise be
+    # written out again when its handler is garbage collected.
+    _log_collector = RecordCollector()
+    _inherited_handlers = list(logger.handlers)
+    for handler in _inherited_handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(_log_collector)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    if HAVE_TESSEROCR:
+        # Imported here rather than at the top so libtesseract is loaded after
+        # main() has set OMP_THREAD_LIMIT
+        import tesserocr
+        try:
+            _tess_api = tesserocr.PyTessBaseAPI(lang="eng", psm=tesserocr.PSM.AUTO)
+        except RuntimeError:
+            _tess_api = None  # e.g. missing tessdata; fall back to the tesseract command
+
+# Function to read the concatenated PNGs gs or convert writes to stdout one PNG
+# per page, yielding each as soon as it is complete. Walks the chunk headers to
+# each IEND rather than searching for the signature, which may also turn up
+# inside compressed image data. source names the command in errors.
+def read_png_stream(stream, source):
+    # Function to read exactly size bytes, failing if the stream ends first
+    def read_exactly(size):
+        data = stream.read(size)
+        if len(data) != size:
+            raise RuntimeError(f"truncated PNG stream from {source}")
+        return data
+
+    while True:
+        signature = stream.read(len(PNG_SIGNATURE))
+        if not signature:
+            return
+        if signature != PNG_SIGNATURE:
+            raise RuntimeError(f"truncated PNG stream from {source}" if PNG_SIGNATURE.startswith(signature)
+                               else f"unexpected data instead of a PNG from {source}")
+        parts = [signature]
+        chunk_type = None
+        while chunk_type != b"IEND":
+            header = read_exactly(8)
+            length, chunk_type = struct.unpack(">I4s", header)
+            parts.append(header)
+            parts.append(read_exactly(length + 4))  # data and CRC
+        yield b"".join(parts)
+
+# Function to render a PDF one page at a time. Yields (page_base_name, image,
+# text) tuples, where image is a PIL image from PDFium or PNG bytes from gs or
+# convert.
+# Pages that already carry a text layer are not rendered: image is None and
+# text holds the embedded text instead. page_indices limits PDFium to the given
+# pages; None renders them all.
+def render_pages(pdf_file, base_name, cfg, page_indices=None):
+    if pdfium is None:
+        if _gs_bin:
+            # Ghostscript renders the PDF itself, page after page and with several
+            # threads per page, without ImageMagick loading the whole document first
+            cmd = [_gs_bin, "-q", "-dNOPAUSE", "-dBATCH", "-dSAFER", "-sDEVICE=png16m", f"-r{cfg.dpi}",
+                   f"-dNumRenderingThreads={cfg.render_threads}", "-sstdout=%stderr", "-sOutputFile=-", pdf_file]
+        else:
+            cmd = [_convert_bin, "-density", str(cfg.dpi), pdf_file, "-quality", "100", "png:-"]
+        # Read the pages from stdout instead of writing, finding and deleting a
+        # PNG file per page. Each page is handed on as soon as it has been read,
+        # so OCR can start while the rest are still being rendered.
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        finished = False
+        try:
+            for page_index, png_bytes in enumerate(read_png_stream(proc.stdout, os.path.basename(cmd[0]))):
+                yield f"{base_name}-{page_index}", png_bytes, None
+            finished = True
+        finally:
+            proc.stdout.close()
+            if not finished:
+                proc.kill()  # stopped early, e.g. on --error-handling exit
+            proc.wait()
+        # A damaged PDF may still have given some pages; it was not fully rendered
+        if proc.returncode != 0:
+            raise RuntimeError(f"{os.path.basename(cmd[0])} exited with status {proc.returncode}")
+        return
+    pdf = pdfium.PdfDocument(pdf_file)
     try:
-        os.remove(png_file)
+        if page_indices is None:
+            page_indices = range(len(pdf))
+        for page_index in page_indices:
+            page = pdf[page_index]
+            page_base_name = f"{base_name}-{page_index}"
+            if not cfg.force_ocr:
+                # Born-digital pages have exact text already; no need to rasterize and OCR them
+                textpage = page.get_textpage()
+                text = textpage.get_text_range() if textpage.count_chars() > 0 else ""
+                textpage.close()
+                if text.strip():
+                    page.close()
+                    yield page_base_name, None, text.replace("\r\n", "\n")
+                    continue
+            # PDF user space is 72 DPI, so scale up to the requested resolution
+            image = page.render(scale=cfg.dpi / 72).to_pil()
+            page.close()
+            yield page_base_name, image, None
+    finally:
+        pdf.close()
+
+# Function to save an in-memory page image as a PNG file
+def save_png(image, png_file):
+    logger.info(f"Saving {png_file}...")
+    try:
+        if isinstance(image, bytes):
+            with open(png_file, "wb") as f:
+                f.write(image)
+        else:
+            image.save(png_file)
     except Exception as e:
-        log_print(f"{timestamp()}: Error: Failed to delete {png_file}: {e}", log_file, quiet)
+        logger.error(f"Error: Failed to save {png_file}: {e}")
         return 1
     return 0
 
-# Function to handle errors based on user preference
-def handle_error(error_msg, log_file, quiet, error_handling):
-    log_print(error_msg, log_file, quiet)
-    if error_handling == "exit":
-        log_print(f"{timestamp()}: Exiting script due to error as per --error-handling 'exit' option.", log_file, quiet)
-        sys.exit(1)
+# Function to extract text from a page image (PIL image or PNG bytes) with the
+# worker's tesserocr engine
+def ocr_image(image):
+    if isinstance(image, bytes):
+        from PIL import Image  # always available, tesserocr depends on Pillow
+        image = Image.open(io.BytesIO(image))
+    _tess_api.SetImage(image)
+    return _tess_api.GetUTF8Text()
 
-# Function to append text to a single file with a header
-def append_to_single_file(pdf_file, text_file, single_file, log_file, quiet):
-    if not os.path.isfile(text_file):
-        return False
+# Function to extract text from a page image with the tesseract command,
+# raising RuntimeError if Tesseract failed
+async def ocr_image_async(image):
+    if isinstance(image, bytes):
+        image_bytes = image
+    else:
+        # Pipe the page in as uncompressed PPM, so there is no PNG encode or decode
+        buf = io.BytesIO()
+        image.save(buf, format="PPM")
+        image_bytes = buf.getvalue()
+    proc = await asyncio.create_subprocess_exec(_tesseract_bin, "stdin", "stdout", "-l", "eng", "txt",
+                                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     try:
-        with open(text_file, "r") as src, open(single_file, "a") as dest:
-            dest.write(f"\n=== {pdf_file} ===\n")
-            dest.write(src.read())
-            dest.write("\n")
-        log_print(f"{timestamp()}: Appended text from {text_file} to {single_file}", log_file, quiet)
-        os.remove(text_file)  # Remove temp file after appending
-        return True
+        stdout, _ = await proc.communicate(image_bytes)
+    except asyncio.CancelledError:
+        # Cancelling communicate() leaves tesseract running, so stop it here
+        proc.kill()
+        await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise RuntimeError(f"tesseract exited with status {proc.returncode}")
+    return stdout.decode("utf-8")
+
+# Function to OCR pages as they are rendered. Yields (page, text, error) in page
+# order; with the tesseract command, up to `concurrency` pages are OCR'd at once.
+# Pages with embedded text are passed through without OCR.
+def ocr_pages(pages, concurrency):
+    if _tess_api is not None:
+        for page in pages:
+            try:
+                yield page, page[2] if page[2] is not None else ocr_image(page[1]), None
+            except Exception as e:
+                yield page, None, e
+        return
+
+    loop = asyncio.new_event_loop()
+    in_flight = collections.deque()
+
+    # Function to wait for the oldest page still being OCR'd
+    def next_done():
+        page, task = in_flight.popleft()
+        try:
+            return page, loop.run_until_complete(task), None
+        except Exception as e:
+            return page, None, e
+
+    # Function to get the next page while the loop keeps feeding and reading the
+    # tesseract processes already started. Rendering or reading a page blocks,
+    # so it is done in a thread rather than on the loop itself.
+    def next_page():
+        return loop.run_until_complete(loop.run_in_executor(None, next, pages, None))
+
+    try:
+        render_error = None
+        try:
+            for page in iter(next_page, None):
+                if page[2] is not None:
+                    task = loop.create_future()
+                    task.set_result(page[2])
+                else:
+                    task = loop.create_task(ocr_image_async(page[1]))
+                in_flight.append((page, task))
+                if len(in_flight) >= concurrency:
+                    yield next_done()
+        except Exception as e:
+            render_error = e  # report it once the pages already rendered are done
+        while in_flight:
+            yield next_done()
+        if render_error is not None:
+            raise render_error
+    finally:
+        # Stop any tesseract processes left over from an error (each task kills
+        # its own process when cancelled) and close the loop
+        tasks = [task for _, task in in_flight]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            loop.run_until_complete(asyncio.wait(tasks))
+        loop.close()
+
+# Function to convert pages of a PDF to text, run inside a worker process. A
+# task is a (pdf_file, page_indices) pair, with page_indices None for all pages.
+# Log records are collected in the result and written out by the main process.
+def process_pages(task, cfg):
+    pdf_file, page_indices = task
+    result = PdfResult(pdf_file)
+    try:
+        convert_pages(pdf_file, page_indices, cfg, result)
+    except SystemExit:
+        # handle_error() asked to stop; the main process shuts the pool down
+        result.exit_requested = True
+    result.log_records = _log_collector.take()
+    return result
+
+# Function to run the page rendering and OCR steps for pages of one PDF
+def convert_pages(pdf_file, page_indices, cfg, result):
+    base_name = os.path.basename(pdf_file)[:-len(".pdf")]  # only *.pdf files are picked up
+    save_pngs = cfg.no_delete or cfg.keep_pngs
+
+    # Step 4: Render the PDF page by page (multi-page support)
+    if page_indices is None or 0 in page_indices:
+        logger.info(f"Converting {pdf_file} to page images...")
+    try:
+        pages = render_pages(pdf_file, base_name, cfg, page_indices)
+        for (page_base_name, image, _), text, error in ocr_pages(pages, cfg.ocr_concurrency):
+            # With --single-file the text goes straight to the main process, not to a file per page
+            text_file = cfg.single_file or f"{cfg.output_dir}/{page_base_name}.txt"
+
+            # Step 5: Convert the page to text using Tesseract, or its own text layer
+            if image is None:
+                logger.info(f"Extracting embedded text of page {page_base_name} to {text_file}...")
+            else:
+                logger.info(f"Converting page {page_base_name} to {text_file}...")
+            if error is None and text is not None and not cfg.single_file:
+                try:
+                    with open(text_file, "w") as f:
+                        f.write(text)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                handle_error(f"Error: Failed to convert page {page_base_name} to {text_file}: {error}", cfg.error_handling)
+                result.errors += 1
+                result.file_had_error = True
+                text = None
+
+            # Step 6: Handle text output (single file appends are done by the main process)
+            if text is not None:
+                if cfg.single_file:
+                    result.texts.append((f"{page_base_name}.pdf", text))
+                result.success_pages += 1
+                if save_pngs and image is not None:
+                    result.errors += save_png(image, f"{page_base_name}.png")
+            else:
+                result.fail_pages += 1
+                # Leave the page behind as a PNG for inspection (embedded text pages have no image)
+                if image is not None:
+                    result.errors += save_png(image, f"{page_base_name}.png")
     except Exception as e:
-        log_print(f"{timestamp()}: Error: Failed to append {text_file} to {single_file}: {e}", log_file, quiet)
+        result.errors += 1
+        result.file_had_error = True
+        result.render_failed = True
+        if page_indices is None:
+            handle_error(f"Error: Failed to convert {pdf_file} to page images: {e}", cfg.error_handling)
+        else:
+            # The task's pages not converted by now are the ones that failed to render
+            failed_pages = [f"{base_name}-{page_index}"
+                            for page_index in page_indices[result.success_pages + result.fail_pages:]]
+            result.fail_pages += len(failed_pages)
+            handle_error(f"Error: Failed to render page {', '.join(failed_pages)} of {pdf_file}: {e}", cfg.error_handling)
+
+# Function to fold the result of another task for the same PDF into result
+def merge_result(result, other):
+    result.success_pages += other.success_pages
+    result.fail_pages += other.fail_pages
+    result.errors += other.errors
+    result.file_had_error = result.file_had_error or other.file_had_error
+    result.render_failed = result.render_failed or other.render_failed
+    result.texts.extend(other.texts)
+
+# Function to finish a PDF once all of its pages are done, run in the main
+# process. Returns True if every page was rendered and converted.
+def finish_pdf(result, cfg):
+    pdf_file = result.pdf_file
+    page_success = result.success_pages
+    page_fail = result.fail_pages
+
+    # Check if any pages were rendered
+    if page_success + page_fail == 0:
+        logger.info(f"No pages rendered for {pdf_file}.")
+        logger.info(f"Skipping deletion of {pdf_file} due to conversion failure.")
+        logger.info(f"Processing of {pdf_file} incomplete due to errors.")
+        return False
+
+    # Step 7: Delete PDF file if all of its pages were rendered (unless prevented)
+    if result.render_failed:
+        logger.info(f"Skipping deletion of {pdf_file} due to conversion failure.")
+    elif result.write_failed:
+        logger.info(f"Skipping deletion of {pdf_file} due to failure writing its text.")
+    else:
+        if delete_pdf(pdf_file, cfg.no_delete, cfg.keep_pdfs):
+            result.errors += 1
+            result.file_had_error = True
+
+    if result.render_failed:
+        logger.info(f"Processing of {pdf_file} incomplete due to conversion failure: "
+                    f"{page_success} pages succeeded, {page_fail} pages failed")
         return False
+    if page_fail == 0 and page_success > 0:
+        logger.info(f"Successfully processed {pdf_file} (all {page_success} pages)")
+        return True
+    logger.info(f"Processing of {pdf_file} incomplete: {page_success} pages succeeded, {page_fail} pages failed")
+    return False
+
+# Function to split the input PDFs into tasks for the pool. With PDFium each
+# page is its own task, so a large PDF is spread over all the workers instead
+# of keeping one busy long after the rest are done; gs and convert render a
+# whole PDF in one call, so they get one task per PDF.
+def build_tasks(pdf_files):
+    tasks = []
+    for pdf_file in pdf_files:
+        page_count = 0
+        if pdfium is not None:
+            try:
+                pdf = pdfium.PdfDocument(pdf_file)
+                page_count = len(pdf)
+                pdf.close()
+            except Exception:
+                pass  # let the worker run into and report the error
+        if page_count > 0:
+            tasks.extend((pdf_file, [page_index]) for page_index in range(page_count))
+        else:
+            tasks.append((pdf_file, None))
+    return tasks
+
+# Function to log the end-of-run summary. The lines go out as separate records
+# so each keeps its timestamp; the buffered log file handler writes them together.
+def log_summary(headline, success_count, fail_count, error_count, start_time, files_with_errors):
+    duration = int(time.time() - start_time)
+    lines = [headline,
+             "Summary:",
+             f"  Total files successfully processed: {success_count}",
+             f"  Total files not processed: {fail_count}",
+             f"  Total errors encountered: {error_count}",
+             f"  Script duration: {duration} seconds"]
+    if files_with_errors:
+        lines.append("Files with errors:")
+        lines.extend(f"  - {file}" for file in files_with_errors)
+    for line in lines:
+        logger.info(line)
+
+# Function to append the text of a PDF's pages to the single file, run in the
+# main process. The PDF's text goes out in one unbuffered write, so a failure
+# is reported for this PDF, before it may be deleted, and leaves nothing behind
+# to surface on a later write. Failed pages are counted in result.
+def append_to_single_file(result, single_fh, single_file):
+    data = memoryview("".join(f"\n=== {header} ===\n{text}\n" for header, text in result.texts).encode("utf-8"))
+    try:
+        while data:
+            data = data[single_fh.write(data):]
+    except Exception as e:
+        logger.error(f"Error: Failed to append text of {result.pdf_file} to {single_file}: {e}")
+        result.success_pages -= len(result.texts)
+        result.fail_pages += len(result.texts)
+        result.errors += 1
+        result.file_had_error = True
+        result.write_failed = True
+    result.texts = []
 
-# Function to check dependencies
+# Function to check dependencies, returning the resolved paths of the gs,
+# convert and tesseract commands (None where a command is not used)
+@lru_cache(maxsize=None)
 def check_dependencies():
     missing = []
+    # Without pypdfium2, Ghostscript is preferred over ImageMagick, which
+    # itself hands PDFs to Ghostscript
+    gs_bin = None if pdfium is not None else shutil.which("gs")
+    convert_bin = None if pdfium is not None or gs_bin else shutil.which("convert")
+    tesseract_bin = shutil.which("tesseract")  # also the fallback if tesserocr fails to start
     
     # Check Python 3 (should always pass if script is running, but included for completeness)
     if sys.version_info < (3, 0):
@@ -80,19 +529,22 @@ def check_dependencies():
                        "  - macOS: brew install python\n"
                        "  - Linux: sudo apt-get install python3 (Ubuntu/Debian) or sudo dnf install python3 (Fedora)")
 
-    # Check ImageMagick (convert)
-    if not shutil.which("convert"):
-        missing.append("ImageMagick is missing (required for 'convert'). Install it:\n"
-                       "  - macOS: brew install imagemagick\n"
-                       "  - Linux: sudo apt-get install imagemagick (Ubuntu/Debian) or sudo dnf install imagemagick (Fedora)\n"
-                       "  - Windows: Download from https://imagemagick.org/script/download.php")
+    # Check Ghostscript (gs) or ImageMagick (convert), only needed when pypdfium2 is not installed
+    if pdfium is None and not gs_bin and not convert_bin:
+        missing.append("Ghostscript is missing (required for 'gs'). Install it:\n"
+                       "  - macOS: brew install ghostscript\n"
+                       "  - Linux: sudo apt-get install ghostscript (Ubuntu/Debian) or sudo dnf install ghostscript (Fedora)\n"
+                       "  - Windows: Download from https://ghostscript.com/releases/gsdnld.html\n"
+                       "  - Or ImageMagick's 'convert': https://imagemagick.org/script/download.php\n"
+                       "  - Or, for faster in-process rendering instead: pip install pypdfium2 pillow")
 
-    # Check Tesseract
-    if not shutil.which("tesseract"):
+    # Check Tesseract (the tesserocr bindings replace the tesseract command)
+    if not HAVE_TESSEROCR and not tesseract_bin:
         missing.append("Tesseract OCR is missing. Install it:\n"
                        "  - macOS: brew install tesseract\n"
                        "  - Linux: sudo apt-get install tesseract-ocr (Ubuntu/Debian) or sudo dnf install tesseract (Fedora)\n"
-                       "  - Windows: Download from https://github.com/UB-Mannheim/tesseract/wiki")
+                       "  - Windows: Download from https://github.com/UB-Mannheim/tesseract/wiki\n"
+                       "  - Optionally, for faster OCR: pip install tesserocr")
 
     if missing:
         print("Error: The following dependencies are missing:")
@@ -100,187 +552,208 @@ def check_dependencies():
             print(dep)
         print("Please install the missing dependencies and try again.")
         sys.exit(1)
+    return gs_bin, convert_bin, tesseract_bin
 
-# Set up argument parser with detailed help
-parser = argparse.ArgumentParser(
-    description="A script to preprocess multi-page PDF files by converting them to PNGs and extracting text using ImageMagick and Tesseract. "
-                "Processes all pages of each PDF, logs progress and errors, and provides a summary of results.",
-    epilog="Examples:\n"
-           "  python3 preprocess_pdfs.py                    # Process PDFs with default settings\n"
-           "  python3 preprocess_pdfs.py -i ./pdfs          # Process PDFs from './pdfs'\n"
-           "  python3 preprocess_pdfs.py -o ./text          # Save text to './text'\n"
-           "  python3 preprocess_pdfs.py -q -l errors.log   # Quiet mode, log to 'errors.log'\n"
-           "  python3 preprocess_pdfs.py -k                 # Keep PDFs\n"
-           "  python3 preprocess_pdfs.py -p                 # Keep PNGs\n"
-           "  python3 preprocess_pdfs.py -n                 # Keep all files\n"
-           "  python3 preprocess_pdfs.py -e exit            # Exit on first error\n"
-           "  python3 preprocess_pdfs.py -s all_text.txt    # Append all text to 'all_text.txt'\n"
-           "  python3 preprocess_pdfs.py -i pdfs -o text -q -l mylog.txt -n -e continue -s combined.txt  # Combined options",
-    formatter_class=argparse.RawDescriptionHelpFormatter
-)
-parser.add_argument("-i", "--input-dir", default=".", 
-                    help="Directory containing PDF files to process (default: current directory '.')")
-parser.add_argument("-o", "--output-dir", default="extracted-text", 
-                    help="Directory where extracted text files will be saved (default: 'extracted-text')")
-parser.add_argument("-q", "--quiet", action="store_true", 
-                    help="Limit terminal output and log file entries to errors only (default: verbose output)")
-parser.add_argument("-l", "--log-file", 
-                    help="Custom name for the log file (default: 'preprocess_log_YYYYMMDD_HHMMSS.txt')")
-parser.add_argument("-k", "--keep-pdfs", action="store_true", 
-                    help="Prevent deletion of original PDF files (default: delete PDFs)")
-parser.add_argument("-p", "--keep-pngs", action="store_true", 
-                    help="Prevent deletion of intermediate PNG files (default: delete PNGs)")
-parser.add_argument("-n", "--no-delete", action="store_true", 
-                    help="Prevent deletion of any files (PDFs and PNGs), overrides --keep-pdfs and --keep-pngs")
-parser.add_argument("-e", "--error-handling", choices=["exit", "continue"], default="continue",
-                    help="Action on error: 'exit' to stop script, 'continue' to proceed (default: 'continue')")
-parser.add_argument("-s", "--single-file", 
-                    help="Append all extracted text to a single file with headers (default: separate files per page)")
-args = parser.parse_args()
-
-# Check dependencies before proceeding
-check_dependencies()
-
-# Set variables from arguments
-input_dir = args.input_dir
-output_dir = args.output_dir
-quiet = args.quiet
-log_file = args.log_file if args.log_file else f"preprocess_log_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-keep_pdfs = args.keep_pdfs
-keep_pngs = args.keep_pngs
-no_delete = args.no_delete
-error_handling = args.error_handling
-single_file = args.single_file
-
-# Start time tracking
-start_time = time.time()
-
-# Initialize counters and error tracking
-success_count = 0
-fail_count = 0
-error_count = 0
-files_with_errors = []
-
-# Step 1 & 2: Verify and create output directory
-log_print(f"{timestamp()}: Directory '{output_dir}' check...", log_file, quiet)
-if not os.path.isdir(output_dir):
-    log_print(f"{timestamp()}: Directory '{output_dir}' does not exist. Creating it now...", log_file, quiet)
+# Function to check that tesserocr can start a Tesseract engine, for when there
+# is no tesseract command to fall back on. Run once OMP_THREAD_LIMIT is set, as
+# it loads libtesseract into the main process.
+def check_tesserocr():
+    import tesserocr
     try:
-        os.makedirs(output_dir, exist_ok=True)
-    except Exception as e:
-        handle_error(f"{timestamp()}: Error: Failed to create '{output_dir}' directory: {e}", log_file, quiet, error_handling)
-        error_count += 1
-else:
-    log_print(f"{timestamp()}: Directory '{output_dir}' already exists.", log_file, quiet)
-
-# Check if there are no PDF files in the input directory
-log_print(f"{timestamp()}: Checking for PDF files in '{input_dir}'...", log_file, quiet)
-pdf_files = glob.glob(os.path.join(input_dir, "*.pdf"))
-if not pdf_files:
-    log_print(f"{timestamp()}: No PDF files found in '{input_dir}'.", log_file, quiet)
-    log_print(f"{timestamp()}: Preprocessing complete! No files to process.", log_file, quiet)
-    log_print(f"{timestamp()}: Summary:", log_file, quiet)
-    log_print(f"{timestamp()}:   Total files successfully processed: {success_count}", log_print, quiet)
-    log_print(f"{timestamp()}:   Total files not processed: {fail_count}", log_file, quiet)
-    log_print(f"{timestamp()}:   Total errors encountered: {error_count}", log_file, quiet)
-    duration = int(time.time() - start_time)
-    log_print(f"{timestamp()}:   Script duration: {duration} seconds", log_file, quiet)
-    if files_with_errors:
-        log_print(f"{timestamp()}: Files with errors:", log_file, quiet)
-        for file in files_with_errors:
-            log_print(f"{timestamp()}:   - {file}", log_file, quiet)
-    exit(0)
-
-# Step 3: Process each PDF file
-for pdf_file in pdf_files:
-    base_name = Path(pdf_file).stem
-    file_had_error = False
-
-    # Step 4: Convert PDF to PNGs (multi-page support)
-    log_print(f"{timestamp()}: Converting {pdf_file} to PNGs...", log_file, quiet)
+        tesserocr.PyTessBaseAPI(lang="eng", psm=tesserocr.PSM.AUTO).End()
+    except RuntimeError as e:
+        logger.error(f"Error: tesserocr could not start Tesseract: {e}")
+        logger.error("Install Tesseract's English language data (tessdata), set TESSDATA_PREFIX to its directory, "
+                     "or install the tesseract command as a fallback:\n"
+                     "  - macOS: brew install tesseract\n"
+                     "  - Linux: sudo apt-get install tesseract-ocr (Ubuntu/Debian) or sudo dnf install tesseract (Fedora)")
+        sys.exit(1)
+
+# Function to parse an option value that must be a whole number of at least 1
+def positive_int(value):
     try:
-        subprocess.run(["convert", "-density", "300", pdf_file, "-quality", "100", f"{base_name}-%d.png"], check=False, stderr=subprocess.DEVNULL)
-    except Exception as e:
-        handle_error(f"{timestamp()}: Error: Failed to convert {pdf_file} to PNGs: {e}", log_file, quiet, error_handling)
-        error_count += 1
-        file_had_error = True
-
-    # Check if any PNGs were created
-    png_files = glob.glob(f"{base_name}-[0-9]*.png")
-    if not png_files:
-        log_print(f"{timestamp()}: No PNG files generated for {pdf_file}.", log_file, quiet)
-        log_print(f"{timestamp()}: Skipping deletion of {pdf_file} due to conversion failure.", log_file, quiet)
-        log_print(f"{timestamp()}: Processing of {pdf_file} incomplete due to errors.", log_file, quiet)
-        fail_count += 1
-        if not file_had_error:  # Only add if not already added from conversion error
-            files_with_errors.append(pdf_file)
-        continue
-
-    # Step 5: Delete PDF file if conversion succeeded (unless prevented)
-    error_count += delete_pdf(pdf_file, log_file, quiet, no_delete, keep_pdfs)
-    if error_count > (len(png_files) + 1):  # Adjust based on prior errors
-        file_had_error = True
-
-    # Process each PNG file (multi-page handling)
-    page_success = 0
-    page_fail = 0
-    for png_file in png_files:
-        page_base_name = Path(png_file).stem
-        temp_text_file = f"{output_dir}/{page_base_name}.txt"
-
-        # Step 6: Convert PNG to text using Tesseract
-        log_print(f"{timestamp()}: Converting {png_file} to {temp_text_file}...", log_file, quiet)
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+# Function to set up argument parser with detailed help
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="A script to preprocess multi-page PDF files by converting them to PNGs and extracting text using PDFium (or Ghostscript/ImageMagick) and Tesseract. "
+                    "Processes several PDFs in parallel, logs progress and errors, and provides a summary of results.",
+        epilog="Examples:\n"
+               "  python3 preprocess_pdfs.py                    # Process PDFs with default settings\n"
+               "  python3 preprocess_pdfs.py -i ./pdfs          # Process PDFs from './pdfs'\n"
+               "  python3 preprocess_pdfs.py -o ./text          # Save text to './text'\n"
+               "  python3 preprocess_pdfs.py -q -l errors.log   # Quiet mode, log to 'errors.log'\n"
+               "  python3 preprocess_pdfs.py -k                 # Keep PDFs\n"
+               "  python3 preprocess_pdfs.py -p                 # Keep PNGs\n"
+               "  python3 preprocess_pdfs.py -n                 # Keep all files\n"
+               "  python3 preprocess_pdfs.py -e exit            # Exit on first error\n"
+               "  python3 preprocess_pdfs.py -s all_text.txt    # Append all text to 'all_text.txt'\n"
+               "  python3 preprocess_pdfs.py -j 4               # Use at most 4 worker processes\n"
+               "  python3 preprocess_pdfs.py -d 300             # Render pages at 300 DPI for small print\n"
+               "  python3 preprocess_pdfs.py -i pdfs -o text -q -l mylog.txt -n -e continue -s combined.txt  # Combined options",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-i", "--input-dir", default=".", 
+                        help="Directory containing PDF files to process (default: current directory '.')")
+    parser.add_argument("-o", "--output-dir", default="extracted-text", 
+                        help="Directory where extracted text files will be saved (default: 'extracted-text')")
+    parser.add_argument("-q", "--quiet", action="store_true", 
+                        help="Limit terminal output and log file entries to errors only (default: verbose output)")
+    parser.add_argument("-l", "--log-file", 
+                        help="Custom name for the log file (default: 'preprocess_log_YYYYMMDD_HHMMSS.txt')")
+    parser.add_argument("-k", "--keep-pdfs", action="store_true", 
+                        help="Prevent deletion of original PDF files (default: delete PDFs)")
+    parser.add_argument("-p", "--keep-pngs", "--save-pngs", action="store_true", 
+                        help="Keep a PNG file of every rendered page; pages read from their embedded text have none (default: pages stay in memory)")
+    parser.add_argument("-n", "--no-delete", action="store_true", 
+                        help="Prevent deletion of any files (PDFs and PNGs), overrides --keep-pdfs and --keep-pngs")
+    parser.add_argument("-e", "--error-handling", choices=["exit", "continue"], default="continue",
+                        help="Action on error: 'exit' to stop script, 'continue' to proceed (default: 'continue')")
+    parser.add_argument("-s", "--single-file", 
+                        help="Append all extracted text to a single file with headers (default: separate files per page)")
+    parser.add_argument("-j", "--jobs", type=positive_int, default=os.cpu_count() or 1,
+                        help="Number of worker processes converting pages in parallel (default: number of CPU cores)")
+    parser.add_argument("-d", "--dpi", type=positive_int, default=200,
+                        help="Resolution to render pages at for OCR (default: 200)")
+    parser.add_argument("--force-ocr", action="store_true",
+                        help="OCR every page, even pages that already contain text (default: use the embedded text when present, needs pypdfium2)")
+    parser.add_argument("--ocr-concurrency", type=positive_int,
+                        help="Number of pages of one PDF the tesseract command works on at once when rendering with gs or convert "
+                             "(default: CPU cores divided by the number of workers; not used with pypdfium2, whose tasks are single pages, "
+                             "or with tesserocr)")
+    parser.add_argument("--tesseract-threads", type=positive_int,
+                        help="Number of threads each Tesseract instance may use (default: OMP_THREAD_LIMIT if set, otherwise 1)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    # Check dependencies before proceeding
+    gs_bin, convert_bin, tesseract_bin = check_dependencies()
+
+    # Set variables from arguments
+    input_dir = args.input_dir
+    output_dir = args.output_dir
+    quiet = args.quiet
+    log_file = args.log_file if args.log_file else f"preprocess_log_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    error_handling = args.error_handling
+    single_file = args.single_file
+    setup_logging(log_file, quiet)
+
+    # Start time tracking
+    start_time = time.time()
+
+    # Initialize counters and error tracking
+    success_count = 0
+    fail_count = 0
+    error_count = 0
+    files_with_errors = {}  # used as an insertion-ordered set
+
+    # Step 1 & 2: Verify and create output directory
+    logger.info(f"Directory '{output_dir}' check...")
+    if not os.path.isdir(output_dir):
+        logger.info(f"Directory '{output_dir}' does not exist. Creating it now...")
         try:
-            subprocess.run(["tesseract", png_file, f"{output_dir}/{page_base_name}", "-l", "eng", "txt"], check=False, stderr=subprocess.DEVNULL)
+            os.makedirs(output_dir, exist_ok=True)
         except Exception as e:
-            handle_error(f"{timestamp()}: Error: Failed to convert {png_file} to {temp_text_file}: {e}", log_file, quiet, error_handling)
+            handle_error(f"Error: Failed to create '{output_dir}' directory: {e}", error_handling)
             error_count += 1
-            file_had_error = True
+    else:
+        logger.info(f"Directory '{output_dir}' already exists.")
 
-        # Step 7: Handle text output (single file or separate)
-        if os.path.isfile(temp_text_file):
-            if single_file:
-                if append_to_single_file(f"{page_base_name}.pdf", temp_text_file, single_file, log_file, quiet):
-                    page_success += 1
-                else:
-                    page_fail += 1
-                    file_had_error = True
+    # Check if there are no PDF files in the input directory
+    logger.info(f"Checking for PDF files in '{input_dir}'...")
+    # scandir gets the entry type from the directory listing itself, so large
+    # directories are filtered without a stat() per entry (only symlinks, which
+    # are followed, need one). Matches *.pdf and *.PDF; like the earlier glob,
+    # hidden files are skipped. This stays a list: its
+    # length sizes the pool, and build_tasks() needs every page count up front.
+    try:
+        with os.scandir(input_dir) as entries:
+            pdf_files = [entry.path for entry in entries
+                         if entry.name.lower().endswith(".pdf") and not entry.name.startswith(".")
+                         and entry.is_file()]
+    except OSError as e:
+        logger.error(f"Error: Failed to read '{input_dir}': {e}")
+        pdf_files = []
+    if not pdf_files:
+        logger.info(f"No PDF files found in '{input_dir}'.")
+        log_summary("Preprocessing complete! No files to process.", success_count, fail_count, error_count,
+                    start_time, files_with_errors)
+        return
+
+    # Tesseract's OpenMP threads only get in each other's way once several
+    # instances run side by side, so keep each one single-threaded unless told
+    # otherwise by --tesseract-threads or an OMP_THREAD_LIMIT already set. Set
+    # before the pool starts so every worker (and its subprocesses) inherits it.
+    if args.tesseract_threads:
+        os.environ["OMP_THREAD_LIMIT"] = str(args.tesseract_threads)
+    else:
+        os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+    # Workers can only fall back to the tesseract command if it was found
+    if HAVE_TESSEROCR and not tesseract_bin:
+        check_tesserocr()
+
+    # Step 3: Process the PDF files in parallel, a page or a PDF per task. For
+    # whole-PDF tasks (gs or convert), cores left over when there are fewer tasks
+    # than cores go to OCR'ing that PDF's pages concurrently and to Ghostscript's
+    # rendering threads. Single-page tasks have nothing to spread out.
+    tasks = build_tasks(pdf_files)
+    workers = max(1, min(args.jobs, len(tasks)))
+    spare_cores = max(1, (os.cpu_count() or 1) // workers)
+    ocr_concurrency = args.ocr_concurrency or spare_cores
+    cfg = Config(output_dir=output_dir, keep_pdfs=args.keep_pdfs, keep_pngs=args.keep_pngs, no_delete=args.no_delete,
+                 error_handling=error_handling, single_file=single_file, ocr_concurrency=ocr_concurrency,
+                 dpi=args.dpi, force_ocr=args.force_ocr, render_threads=spare_cores)
+    # One handle to the single file for the whole run, written only by this process
+    single_fh = open(single_file, "ab", buffering=0) if single_file else contextlib.nullcontext()
+    with single_fh, ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                        initargs=(gs_bin, convert_bin, tesseract_bin)) as executor:
+        # Results come back in task order, so each PDF's tasks arrive one after
+        # another and the PDF is done once the last of them is in
+        tasks_left = collections.Counter(pdf_file for pdf_file, _ in tasks)
+        pdf_result = None
+        for result in executor.map(partial(process_pages, cfg=cfg), tasks):
+            # Write each task's log records in one go so workers never contend for the log file
+            for record in result.log_records:
+                logger.handle(record)
+            if pdf_result is None:
+                pdf_result = result
             else:
-                page_success += 1
+                merge_result(pdf_result, result)
+            if result.exit_requested:
+                if pdf_result.texts:
+                    append_to_single_file(pdf_result, single_fh, single_file)
+                executor.shutdown(cancel_futures=True)
+                sys.exit(1)
+            tasks_left[result.pdf_file] -= 1
+            if tasks_left[result.pdf_file]:
+                continue
 
-            # Delete PNG file if text conversion succeeded (unless prevented)
-            error_count += delete_png(png_file, log_file, quiet, no_delete, keep_pngs)
-            if error_count > (len(png_files) + 1):  # Adjust based on prior errors
-                file_had_error = True
-        else:
-            log_print(f"{timestamp()}: Skipping deletion of {png_file} due to text conversion failure.", log_file, quiet)
-            page_fail += 1
+            if pdf_result.texts:
+                append_to_single_file(pdf_result, single_fh, single_file)
 
-    # Update counters and error tracking
-    if page_fail == 0 and page_success > 0:
-        log_print(f"{timestamp()}: Successfully processed {pdf_file} (all {page_success} pages)", log_file, quiet)
-        success_count += 1
-    else:
-        log_print(f"{timestamp()}: Processing of {pdf_file} incomplete: {page_success} pages succeeded, {page_fail} pages failed", log_file, quiet)
-        fail_count += 1
-        if not file_had_error:  # Only add if not already added from earlier errors
-            files_with_errors.append(pdf_file)
-
-    if file_had_error and pdf_file not in files_with_errors:
-        files_with_errors.append(pdf_file)
-
-# Calculate duration
-duration = int(time.time() - start_time)
-
-# Final summary
-log_print(f"{timestamp()}: Preprocessing complete!", log_file, quiet)
-log_print(f"{timestamp()}: Summary:", log_file, quiet)
-log_print(f"{timestamp()}:   Total files successfully processed: {success_count}", log_file, quiet)
-log_print(f"{timestamp()}:   Total files not processed: {fail_count}", log_file, quiet)
-log_print(f"{timestamp()}:   Total errors encountered: {error_count}", log_file, quiet)
-log_print(f"{timestamp()}:   Script duration: {duration} seconds", log_file, quiet)
-if files_with_errors:
-    log_print(f"{timestamp()}: Files with errors:", log_file, quiet)
-    for file in files_with_errors:
-        log_print(f"{timestamp()}:   - {file}", log_file, quiet)
-log_print(f"{timestamp()}: All output has been logged to {log_file}", log_file, quiet)
+            # Update counters and error tracking
+            success = finish_pdf(pdf_result, cfg)
+            error_count += pdf_result.errors
+            if success:
+                success_count += 1
+            else:
+                fail_count += 1
+            if pdf_result.file_had_error or not success:
+                files_with_errors[pdf_result.pdf_file] = None
+            pdf_result = None
+
+    # Final summary
+    log_summary("Preprocessing complete!", success_count, fail_count, error_count, start_time, files_with_errors)
+    logger.info(f"All output has been logged to {log_file}")
+
+if __name__ == "__main__":
+    main()